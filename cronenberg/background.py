@@ -0,0 +1,47 @@
+import queue
+import threading
+import typing
+
+_END_OF_ITEMS = object()
+
+
+def iter_in_background(items: typing.Iterable, max_pending: int) -> typing.Iterator:
+    """Produce items on a separate thread, at most max_pending ahead of use.
+
+    Any exception raised while producing the items is raised again here.
+    """
+    pending: queue.Queue = queue.Queue(maxsize=max_pending)
+    stopped = threading.Event()
+
+    def put(value) -> bool:
+        while not stopped.is_set():
+            try:
+                pending.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+        except BaseException as error:
+            put((_END_OF_ITEMS, error))
+        else:
+            put((_END_OF_ITEMS, None))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = pending.get()
+            if item is _END_OF_ITEMS:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+        producer.join()
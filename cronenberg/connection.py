@@ -0,0 +1,66 @@
+import os
+import sqlite3
+import typing
+
+# Prepared statements are cached per connection, keyed by the SQL text.
+STATEMENT_CACHE_SIZE = 1000
+
+# Default SQLITE_MAX_ATTACHED for stock builds of SQLite.
+MAX_ATTACHED_DATABASES = 10
+
+JOURNAL_PRAGMAS = """
+    PRAGMA {schema}.journal_mode=WAL;
+    PRAGMA {schema}.synchronous=NORMAL;
+"""
+
+CACHE_PRAGMAS = """
+    PRAGMA temp_store=MEMORY;
+    PRAGMA {schema}.cache_size=-65536;
+    PRAGMA {schema}.mmap_size=10737418240;
+"""
+
+
+def tune_connection(con: sqlite3.Connection, read_only: bool = False, schema: str = "main") -> sqlite3.Connection:
+    """Apply the WAL journal and cache settings used for every database.
+
+    Read-only connections are not allowed to change the journal mode, so
+    they only get the cache settings.
+    """
+    if not read_only:
+        con.executescript(JOURNAL_PRAGMAS.format(schema=schema))
+    con.executescript(CACHE_PRAGMAS.format(schema=schema))
+    return con
+
+
+def connect(filename: str, check_same_thread: bool = True) -> sqlite3.Connection:
+    con = sqlite3.connect(
+        filename,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        check_same_thread=check_same_thread
+    )
+    if filename == ":memory:":
+        # In-memory databases have no journal or file to map.
+        return con
+    return tune_connection(con)
+
+
+def connect_read_only_attached(filenames: typing.Sequence[str]) -> sqlite3.Connection:
+    """Open databases read-only behind one connection, attached as m0, m1, ..."""
+    if len(filenames) > MAX_ATTACHED_DATABASES:
+        raise ValueError(f"At most {MAX_ATTACHED_DATABASES} databases can be attached, got {len(filenames)}")
+    con = sqlite3.connect(":memory:", cached_statements=STATEMENT_CACHE_SIZE)
+    try:
+        for i, filename in enumerate(filenames):
+            # ATTACH creates a missing file instead of failing.
+            if not os.path.isfile(filename):
+                raise FileNotFoundError(filename)
+            # The plain file name is attached, as file: URIs can not express
+            # the UNC paths of network shares.
+            con.execute(f"ATTACH DATABASE ? AS m{i}", (filename,))
+            tune_connection(con, read_only=True, schema=f"m{i}")
+        # Refuses any write through this connection.
+        con.execute("PRAGMA query_only=1")
+    except BaseException:
+        con.close()
+        raise
+    return con
@@ -1,32 +1,60 @@
 import abc
 import itertools
+import operator
 import os.path
 import sqlite3
 import functools
 # from typing import Optional, Type
 import typing
 import contextlib
-from cronenberg import recorder
+from cronenberg import recorder, connection
 DEFAULT_FILE_SYSTEM_MAP_DATA_SCHEME = recorder.DataSchema2()
 
+# Bound to the :sep and :altsep placeholders used by join_path_sql.
+PATH_SEPARATOR_PARAMETERS = {"sep": os.sep, "altsep": os.altsep or os.sep}
+
+
+def join_path_sql(path_expression: str, name_expression: str) -> str:
+    """Build an SQL expression giving the same result as os.path.join.
+
+    Lets SQLite return paths ready to use instead of joining every row in
+    Python. The query must be run with PATH_SEPARATOR_PARAMETERS.
+    """
+    return f"""
+            CASE
+                WHEN {path_expression} = '' THEN {name_expression}
+                WHEN substr({path_expression}, -1) IN (:sep, :altsep) THEN {path_expression} || {name_expression}
+                ELSE {path_expression} || :sep || {name_expression}
+            END"""
+
 
 class SQLiteReportWriter(contextlib.AbstractContextManager):
+    buffer_size = 1000
+
     def __init__(self, filename: str, schema_strategy):
         self.filename = filename
         self._con = None
         self.strategy: ReportDataSchema = schema_strategy
+        self._cur: typing.Optional[sqlite3.Cursor] = None
+        self._pending_matches: typing.List[typing.Tuple[str, int, str, typing.Any]] = []
 
     def __enter__(self):
 
-        self._con = sqlite3.connect(self.filename)
+        self._con = connection.connect(self.filename)
         self.init_tables()
+        self._cur = self._con.cursor()
+        self._cur.execute("BEGIN")
         return self
 
     def __exit__(self, exc_type: typing.Optional[typing.Type[BaseException]],
                  exc_value: typing.Optional[BaseException],
                  traceback) -> typing.Optional[bool]:
         if self._con is not None:
+            self._write_pending_matches()
+            if self._cur is not None:
+                self._cur.close()
             self._con.commit()
+            self.strategy.finalize(self._con.cursor())
             self._con.close()
         return None
 
@@ -36,22 +64,32 @@ class SQLiteReportWriter(contextlib.AbstractContextManager):
         self.strategy.init_tables(cur)
         self._con.commit()
 
+    def _write_pending_matches(self):
+        if not self._pending_matches:
+            return
+        self.strategy.add_matches(self._cur, self._pending_matches)
+        self._pending_matches.clear()
+
     def add_file_duplication_match(self, file_name, matches):
         # file_size = matches
-        cur = self._con.cursor()
-        try:
-            for hash_value, instances in matches.items():
-                file_sizes = {i.size for i in instances}
-                if len(file_sizes) > 1:
-                    raise AttributeError(f"All instances should have the same file size, got {file_sizes}")
-
-                source = {i.source for i in instances}
-                if len(source) > 1:
-                    raise AttributeError(f"All instances should have the same source, got {source}")
-
-                self.strategy.add_match(cur, file_name, file_sizes.pop(), hash_value, instances)
-        finally:
-            self._con.commit()
+        for hash_value, instances in matches.items():
+            remaining_instances = iter(instances)
+            first_instance = next(remaining_instances)
+            file_size = first_instance.size
+            source = first_instance.source
+            for instance in remaining_instances:
+                if instance.size != file_size:
+                    raise AttributeError(
+                        f"All instances should have the same file size, got {file_size} and {instance.size}"
+                    )
+                if instance.source != source:
+                    raise AttributeError(
+                        f"All instances should have the same source, got {source} and {instance.source}"
+                    )
+
+            self._pending_matches.append((file_name, file_size, hash_value, instances))
+        if len(self._pending_matches) >= self.buffer_size:
+            self._write_pending_matches()
 
 
 class ReportDataSchema(abc.ABC):
@@ -63,39 +101,88 @@ class ReportDataSchema(abc.ABC):
     def add_match(self, cursor, file_name, file_size, hash_value, matches):
         pass
 
+    def add_matches(self, cursor, matches):
+        """Add many (file_name, file_size, hash_value, instances) groups."""
+        for file_name, file_size, hash_value, instances in matches:
+            self.add_match(cursor, file_name, file_size, hash_value, instances)
+
+    def finalize(self, cursor):
+        """Called once all matches have been written and committed."""
+
 
 class DupReportDataSchema(ReportDataSchema):
+    INSERT_FILE_SQL = 'INSERT INTO files(fileid,name,size,md5) VALUES (?,?,?,?)'
+    INSERT_FILE_INSTANCE_SQL = 'INSERT INTO file_instances(file_source, source, path) VALUES (?,?,?)'
+
+    PAGE_SIZE = 32768
+
+    # The report is rebuilt from scratch on every run. It is loaded with a
+    # rollback journal, which unlike WAL lets the page size be changed, and
+    # switched back to WAL for the readers once finished.
+    BULK_LOAD_PRAGMAS = f"""
+        PRAGMA journal_mode=TRUNCATE;
+        PRAGMA page_size={PAGE_SIZE};
+        PRAGMA cache_size=-131072;
+    """
+
     def init_tables(self, cursor):
+        cursor.executescript(self.BULK_LOAD_PRAGMAS)
         cursor.execute('DROP TABLE IF EXISTS metadata')
+        cursor.execute('DROP TABLE IF EXISTS files')
+        cursor.execute('DROP TABLE IF EXISTS file_instances')
+        # The page size of an existing database only changes on a vacuum,
+        # which is cheap once all the tables are gone.
+        cursor.execute('PRAGMA page_size')
+        if cursor.fetchone()[0] != self.PAGE_SIZE:
+            cursor.execute('VACUUM')
+
         cursor.execute('CREATE TABLE metadata (version number)')
         cursor.execute('INSERT INTO metadata VALUES (1)')
 
-        cursor.execute('DROP TABLE IF EXISTS files')
         cursor.execute('''
                     CREATE TABLE files
                     (name TEXT NOT NULL , size INTEGER NOT NULL , md5 TEXT NOT NULL, fileid INTEGER PRIMARY KEY )
                     ''')
 
-        cursor.execute('DROP TABLE IF EXISTS file_instances')
         cursor.execute('''
                     CREATE TABLE file_instances(
                     file_source INTEGER, source text, path text,
                     FOREIGN KEY(file_source) REFERENCES files(fileid))
                     ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_name_size ON files(name, size)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_fi_src ON file_instances(file_source)')
 
     def add_match(self, cursor, file_name, file_size, hash_value, matches):
 
-        cursor.execute('INSERT INTO files(name,size,md5) VALUES (?,?,?)', (file_name, file_size, hash_value))
+        cursor.execute(self.INSERT_FILE_SQL, (None, file_name, file_size, hash_value))
         file_id = cursor.lastrowid
         data = []
         for value in matches:
             data.append((file_id, value.source, value.path))
-        cursor.executemany('INSERT INTO file_instances(file_source, source, path) VALUES (?,?,?)', data)
+        cursor.executemany(self.INSERT_FILE_INSTANCE_SQL, data)
+
+    def add_matches(self, cursor, matches):
+        # File ids are assigned here instead of read back from lastrowid so
+        # both tables can be filled with a single executemany each. This is
+        # only safe because the report writer holds the write transaction.
+        cursor.execute('SELECT COALESCE(MAX(fileid), 0) FROM files')
+        next_file_id = cursor.fetchone()[0] + 1
+        files = []
+        instances = []
+        for file_id, (file_name, file_size, hash_value, matching_files) in enumerate(matches, start=next_file_id):
+            files.append((file_id, file_name, file_size, hash_value))
+            for value in matching_files:
+                instances.append((file_id, value.source, value.path))
+        cursor.executemany(self.INSERT_FILE_SQL, files)
+        cursor.executemany(self.INSERT_FILE_INSTANCE_SQL, instances)
+
+    def finalize(self, cursor):
+        cursor.execute("PRAGMA journal_mode=WAL")
 
     @staticmethod
     @contextlib.contextmanager
     def _open_database(db_source):
-        _conn = sqlite3.connect(db_source)
+        _conn = connection.connect(db_source)
         yield _conn
         _conn.close()
     def get_dups_from_database_file(self, source):
@@ -104,8 +191,7 @@ class DupReportDataSchema(ReportDataSchema):
             cursor = conn.cursor()
             try:
                 cursor.execute("SELECT fileid, source, path, name, md5, size from file_instances JOIN main.files f on f.fileid = file_instances.file_source ORDER BY fileid")
-                files_with_dups = cursor.fetchall()
-                sorted_dups = itertools.groupby(files_with_dups, key=lambda x: x[0])
+                sorted_dups = itertools.groupby(cursor, key=operator.itemgetter(0))
                 for group_id, file_group in sorted_dups:
                     dups = []
                     for _group_id, source, path, name, hash_value, size in file_group:
@@ -115,6 +201,33 @@ class DupReportDataSchema(ReportDataSchema):
                 cursor.close()
         return []
 
+    def get_dup_instances_from_database_file(self, source):
+        """Get the full path of every instance of each duplicate.
+
+        Only files with at least two instances are included, and the paths
+        are joined by SQLite. The instances of a file are sorted by path.
+        """
+        instance_path = join_path_sql(join_path_sql("fi.source", "fi.path"), "f.name")
+        conn: sqlite3.Connection
+        with self._open_database(source) as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    f"""
+                    SELECT f.name, f.md5, f.size, group_concat({instance_path}, char(0))
+                    FROM file_instances fi JOIN main.files f on f.fileid = fi.file_source
+                    GROUP BY f.fileid
+                    HAVING COUNT(*) >= 2
+                    ORDER BY f.fileid
+                    """,
+                    PATH_SEPARATOR_PARAMETERS
+                )
+                # group_concat does not guarantee any order of its values.
+                for name, hash_value, size, instances in cursor:
+                    yield (name, hash_value, size), sorted(instances.split("\0"))
+            finally:
+                cursor.close()
+
     def remove_file_instance(self, database_file, source, path, file_name):
         conn: sqlite3.Connection
         with self._open_database(database_file) as conn:
@@ -1,26 +1,24 @@
 import abc
+import contextlib
+import collections
+import concurrent.futures
+import dataclasses
 import itertools
 import sqlite3
 import typing
 import os
 import logging
-import json
+import operator
 import warnings
 from pprint import pprint
 
-from cronenberg import recorder, reports
+from cronenberg import recorder, reports, hashing, connection, background
 from cronenberg.path_scanner import PathScanner
 from cronenberg.database import DEFAULT_FILE_SYSTEM_MAP_DATA_SCHEME, update_dups_database_report, SQLiteReportWriter, DupReportDataSchema
 
 logger = logging.getLogger(__name__)
 
 
-def get_skippable_directories(suppression_file):
-    with open(suppression_file) as file_handle:
-        data = json.loads(file_handle.read())
-        return data['ignore_recursive']
-
-
 class AbsLocateCommand(abc.ABC):
     @abc.abstractmethod
     def run(self) -> None:
@@ -28,6 +26,12 @@ class AbsLocateCommand(abc.ABC):
 
 
 class Locate1(AbsLocateCommand):
+    # Number of scanned files looked up in the maps at a time.
+    batch_size = 1000
+
+    # Batches scanned ahead while the current one is matched and hashed.
+    prefetched_batches = 2
+
     def __init__(self, root: str, output_file: str, map_files: typing.List[str], suppression_file=None):
         self._suppression_file = suppression_file
         self.root = root
@@ -43,21 +47,27 @@ class Locate1(AbsLocateCommand):
                     self.output_file) as report_writer:
                 report_writer.init_tables()
                 scanner = PathScanner()
-                if self._suppression_file is not None and \
-                        os.path.exists(self._suppression_file):
-                    print("Using suppression file")
-                    for skipped_dir in get_skippable_directories(
-                            self._suppression_file):
-                        print(f"Adding: {skipped_dir}")
-                        scanner.slipped_paths.add(skipped_dir)
-                for f in scanner.scan_path(self.root):
-                    logger.info("Checking %s", f)
-                    matches = [os.path.join(*m) for m in reader.find_matches(f)]
-                    if matches:
-                        matches_text = "\n".join([f"----> {line}" for line in sorted(matches)])
-                        logger.info("Found duplicate for %s: \n%s\n", f.name, matches_text)
-                        # logger.info(f"Found duplicate for {f.name}: \n{matches_text}\n")
-                        report_writer.add_duplicates(f, matches)
+                scanner.load_suppressions(self._suppression_file)
+                entries = scanner.scan_entries(self.root)
+                checked_files = 0
+                # The tree keeps being walked, and the files stat-ed, while
+                # a batch is being hashed.
+                batches = background.iter_in_background(
+                    iter(lambda: recorder.probe_entries(itertools.islice(entries, self.batch_size)), {}),
+                    max_pending=self.prefetched_batches
+                )
+                with contextlib.closing(batches):
+                    for probes in batches:
+                        batch_matches = reader.find_probe_matches(probes)
+                        checked_files += len(probes)
+                        logger.info("Checked %d files", checked_files)
+                        for f, (_, file_size) in probes.items():
+                            matches = [os.path.join(*m) for m in batch_matches[f]]
+                            if matches:
+                                matches_text = "\n".join([f"----> {line}" for line in sorted(matches)])
+                                logger.info("Found duplicate for %s: \n%s\n", os.path.basename(f), matches_text)
+                                # logger.info(f"Found duplicate for {f.name}: \n{matches_text}\n")
+                                report_writer.add_duplicates(f, matches, source_size=file_size)
 
 
 class FileDup(typing.NamedTuple):
@@ -68,38 +78,63 @@ class FileDup(typing.NamedTuple):
     # md5: str
     count: int
 
-class FileInstance(typing.NamedTuple):
+@dataclasses.dataclass(frozen=True)
+class FileInstance:
+    __slots__ = ("source", "path", "name", "size", "md5")
     source: str
     path: str
     name: str
     size: int
     md5: str
     # count: int
-def update_hash_value(con, file: FileInstance, hash_value: str):
-    con.execute(
-        '''
-        UPDATE files
-        SET md5 = ?
-        WHERE path=? AND name=?
-        ''',
-        (hash_value, file.path, file.name)
-    )
-    con.commit()
+UPDATE_HASH_SQL = '''
+    UPDATE files
+    SET md5 = ?
+    WHERE path=? AND name=?
+'''
+
+
+def update_hash_values(con, updates: typing.List[typing.Tuple[str, str, str]]):
+    """Write (hash_value, path, name) rows without committing."""
+    con.executemany(UPDATE_HASH_SQL, updates)
+
 class Locate2(AbsLocateCommand):
+    max_hash_workers = hashing.MAX_HASH_WORKERS
+
     def __init__(self, root: str, output_file: str, map_files: typing.List[str], suppression_file=None):
         self._suppression_file = suppression_file
         self.root = root
         self.map_files = map_files
         self.output_file = output_file
+        self._hash_executor: typing.Optional[concurrent.futures.Executor] = None
 
-    def _iter_dups(self, con):
+    @staticmethod
+    def _all_files_sql(number_of_maps: int) -> str:
+        return " UNION ALL ".join(
+            f"SELECT {i} AS map_id, source, path, name, size, md5 FROM m{i}.files"
+            for i in range(number_of_maps)
+        )
+
+    def _iter_dups(
+            self,
+            con,
+            number_of_maps: int
+    ) -> typing.Iterator[typing.Tuple[int, str, int, typing.List[FileInstance]]]:
         cur = con.cursor()
-        for result in cur.execute(
-                'SELECT name, size, COUNT (*) as "Count" '
-                'FROM files GROUP BY name, size '
-                'HAVING Count(*) > 1'
-        ):
-            yield FileDup(*result)
+        rows = cur.execute(
+            f'''
+            WITH all_files AS ({self._all_files_sql(number_of_maps)}),
+            counted_files AS (
+                SELECT *, COUNT(*) OVER (PARTITION BY map_id, name, size) AS copies FROM all_files
+            )
+            SELECT map_id, source, path, name, size, md5
+            FROM counted_files
+            WHERE copies > 1
+            ORDER BY map_id, name, size
+            '''
+        )
+        for (map_id, file_name, file_size), group in itertools.groupby(rows, key=operator.itemgetter(0, 3, 4)):
+            yield map_id, file_name, file_size, [FileInstance(*row[1:]) for row in group]
 
     def run(self) -> None:
         matches_results = self.locate_duplicate_files()
@@ -127,18 +162,35 @@ class Locate2(AbsLocateCommand):
         return matches_results
 
     def _iter_dup_files(self):
-        with recorder.SQLiteReader(
-                self.map_files,
-                schema_strategy=DEFAULT_FILE_SYSTEM_MAP_DATA_SCHEME
-        ) as reader:
-            for con in reader._con:
-                files_with_possible_dups = list(self._iter_dups(con))
-                for i, (file_name, file_size, matches) in enumerate(files_with_possible_dups):
-                    percent_done = i / len(files_with_possible_dups)
-                    print(f"\nLocating duplicates for {file_name} {(percent_done * 100):.3f}%")
-                    matches = list(self._find_matches_based_on_name_and_size(file_name, file_size, con))
-                    exact_files_matching_result = self.compare(matches,
-                                                               lambda *args, con=con: update_hash_value(con, *args))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_hash_workers) as executor:
+            self._hash_executor = executor
+            try:
+                for start in range(0, len(self.map_files), connection.MAX_ATTACHED_DATABASES):
+                    yield from self._iter_attached_dup_files(
+                        self.map_files[start:start + connection.MAX_ATTACHED_DATABASES]
+                    )
+            finally:
+                self._hash_executor = None
+
+    def _iter_attached_dup_files(self, map_files: typing.List[str]):
+        # The maps are attached read-only to a single connection so the
+        # candidates are found by one query, while the newly calculated
+        # hashes are written through a separate connection per map.
+        writers = [connection.connect(map_file) for map_file in map_files]
+        try:
+            reader = connection.connect_read_only_attached(map_files)
+            try:
+                # The groups are found in a single pass over the maps, so
+                # progress is a running count rather than a percentage.
+                for i, (map_id, file_name, file_size, matches) in enumerate(self._iter_dups(reader, len(map_files))):
+                    print(f"\nLocating duplicates for {file_name} (group {i + 1})")
+                    hash_updates: typing.List[typing.Tuple[str, str, str]] = []
+                    exact_files_matching_result = self.compare(
+                        matches,
+                        lambda file, hash_value: hash_updates.append((hash_value, file.path, file.name))
+                    )
+                    if hash_updates:
+                        update_hash_values(writers[map_id], hash_updates)
                     for variation_key, variation_instances in exact_files_matching_result.items():
                         print(f"\"{file_name}\" ({variation_key})")
                         for variation_instance in variation_instances:
@@ -146,6 +198,13 @@ class Locate2(AbsLocateCommand):
                             print(f"---> {x}")
 
                     yield file_name, exact_files_matching_result
+            finally:
+                reader.close()
+            for writer in writers:
+                writer.commit()
+        finally:
+            for writer in writers:
+                writer.close()
 
     def compare(
             self,
@@ -155,13 +214,14 @@ class Locate2(AbsLocateCommand):
         if len(candidates) < 2:
             raise ValueError("Needs more than one candidate")
 
+        unhashed = [candidate for candidate in candidates if not hashing.is_current(candidate.md5)]
+        hash_values = self._hash_candidates(unhashed)
+
         candidates_resolved = []
         for candidate in candidates:
-            if candidate.md5 is None:
-                try:
-                    hash_value = self.get_hash_value(os.path.join(candidate.source, candidate.path, candidate.name))
-                except FileNotFoundError as e:
-                    warnings.warn(f"{e} not found")
+            if not hashing.is_current(candidate.md5):
+                hash_value = hash_values[candidate]
+                if hash_value is None:
                     continue
                 # candidate.md5 = hash_value
                 if update_value:
@@ -176,16 +236,31 @@ class Locate2(AbsLocateCommand):
                 candidates_resolved.append(new_candidate)
             else:
                 candidates_resolved.append(candidate)
-        return {
-            key: list(value) for key, value
-            in itertools.groupby(
-                sorted(candidates_resolved, key=lambda x: x.md5), key=lambda x: x.md5)
-        }
+        groups: typing.DefaultDict[str, typing.List[FileInstance]] = collections.defaultdict(list)
+        for candidate in candidates_resolved:
+            groups[candidate.md5].append(candidate)
+        return dict(groups)
+    def _hash_candidates(
+            self,
+            candidates: typing.List[FileInstance]
+    ) -> typing.Dict[FileInstance, typing.Optional[str]]:
+        if not candidates:
+            return {}
+        if self._hash_executor is not None:
+            return dict(zip(candidates, self._hash_executor.map(self._try_get_hash_value, candidates)))
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(len(candidates), self.max_hash_workers)
+        ) as executor:
+            return dict(zip(candidates, executor.map(self._try_get_hash_value, candidates)))
+
+    def _try_get_hash_value(self, candidate: FileInstance) -> typing.Optional[str]:
+        try:
+            return self.get_hash_value(os.path.join(candidate.source, candidate.path, candidate.name))
+        except FileNotFoundError as e:
+            warnings.warn(f"{e} not found")
+            return None
+
     def get_hash_value(self, file_path: str):
-        return recorder.FileNameSizeMd5Comparison.get_md5(file_path)
-    def _find_matches_based_on_name_and_size(self, file_name: str, file_size: int, con):
-        cur = con.cursor()
-        for result in cur.execute(
-            'SELECT source, path, name, size, md5 FROM files WHERE name = ? AND size = ?', (file_name, file_size)
-        ):
-            yield FileInstance(*result)
\ No newline at end of file
+        if not os.path.isfile(file_path):
+            raise FileNotFoundError(file_path)
+        return hashing.hash_file(file_path)
@@ -1,5 +1,5 @@
+import functools
 import os.path
-import pathlib
 import typing
 
 from dataclasses import dataclass
@@ -20,8 +20,16 @@ class FileData:
     #     # return 3
     #     # return "d"
 
-def scan_file(root, file: pathlib.Path) -> FileData:
-    stat = file.stat()
-    return FileData(size=stat.st_size,
-                    filename=file.name,
-                    path=str(file.parent.relative_to(root)))
\ No newline at end of file
+@functools.lru_cache(maxsize=1024)
+def _relative_directory(directory: str, root: str) -> str:
+    # Files are scanned a directory at a time, so this is mostly a cache hit.
+    return os.path.relpath(directory, root)
+
+
+def scan_file(root: str, file: str, stat_result: typing.Optional[os.stat_result] = None) -> FileData:
+    if stat_result is None:
+        stat_result = os.stat(file)
+    parent, file_name = os.path.split(file)
+    return FileData(size=stat_result.st_size,
+                    filename=file_name,
+                    path=_relative_directory(parent, root))
\ No newline at end of file
@@ -0,0 +1,106 @@
+import hashlib
+import mmap
+import os
+import sys
+import typing
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+CHUNK_SIZE = 1024 * 1024
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+
+# Smaller files are read in one call, which is cheaper than setting up
+# and tearing down a mapping for them.
+MIN_MMAP_SIZE = 64 * 1024
+
+# A 32-bit process cannot map files of 2 GiB or more in one go.
+MAX_MMAP_SIZE = sys.maxsize if sys.maxsize > 2 ** 32 else 2 ** 31 - 1
+
+# Hashing is mostly waiting on I/O, so it uses more threads than there are
+# CPUs, but not so many that the reads start competing with each other.
+MAX_HASH_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+
+FADV_SEQUENTIAL = getattr(os, "POSIX_FADV_SEQUENTIAL", None)
+FADV_DONTNEED = getattr(os, "POSIX_FADV_DONTNEED", None)
+
+# Digests are stored as "<algorithm>:<hex digest>" so values written by an
+# older version (plain md5 hex) or by a machine with a different hash
+# backend are recognised as stale and recalculated instead of compared.
+HASH_ALGORITHM = "blake3" if blake3 is not None else "sha256"
+HASH_PREFIX = f"{HASH_ALGORITHM}:"
+
+
+def _new_hasher():
+    if blake3 is not None:
+        return blake3.blake3()
+    return hashlib.sha256()
+
+
+def is_current(hash_value: typing.Optional[str]) -> bool:
+    """Check if a stored hash value was made with the current algorithm."""
+    return hash_value is not None and hash_value.startswith(HASH_PREFIX)
+
+
+def _advise(file_handle, advice: typing.Optional[int]) -> None:
+    # posix_fadvise is only a hint, and is not available everywhere.
+    if advice is None:
+        return
+    try:
+        os.posix_fadvise(file_handle.fileno(), 0, 0, advice)
+    except OSError:
+        pass
+
+
+def _update_from_mmap(file_hash, file_handle) -> bool:
+    try:
+        mapped = mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return False
+    with mapped:
+        if hasattr(mapped, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        file_hash.update(mapped)
+    return True
+
+
+def _update_from_reads(file_hash, file_handle) -> None:
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    while size := file_handle.readinto(buffer):
+        file_hash.update(view[:size])
+
+
+def digest_file(file_path: str, file_hash):
+    """Feed the contents of a file into a hashlib style hash object."""
+    with open(file_path, "rb") as f:
+        _advise(f, FADV_SEQUENTIAL)
+        file_size = os.fstat(f.fileno()).st_size
+        if not MIN_MMAP_SIZE < file_size <= MAX_MMAP_SIZE or not _update_from_mmap(file_hash, f):
+            _update_from_reads(file_hash, f)
+        # Each file is read once, so it should not push everything else out
+        # of the page cache during a large scan.
+        _advise(f, FADV_DONTNEED)
+    return file_hash
+
+
+def fingerprint_file(file_path: str) -> bytes:
+    """Digest only the start and end of a file.
+
+    Files of the same size with different fingerprints can not have the
+    same contents, which is cheaper to find out than a full hash.
+    """
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        file_hash.update(f.read(FINGERPRINT_BLOCK_SIZE))
+        file_size = os.fstat(f.fileno()).st_size
+        if file_size > FINGERPRINT_BLOCK_SIZE:
+            f.seek(max(FINGERPRINT_BLOCK_SIZE, file_size - FINGERPRINT_BLOCK_SIZE))
+            file_hash.update(f.read(FINGERPRINT_BLOCK_SIZE))
+    return file_hash.digest()
+
+
+def hash_file(file_path: str) -> str:
+    return HASH_PREFIX + digest_file(file_path, _new_hasher()).hexdigest()
@@ -1,34 +1,67 @@
+import json
+import logging
 import typing
 import os
-import pathlib
+import operator
 
-SYSTEM_FILES = [
+logger = logging.getLogger(__name__)
+
+SYSTEM_FILES = frozenset({
     ".DS_Store",
     "._.DS_Store",
     "Thumbs.db",
+})
+
+
+def get_skippable_directories(suppression_file):
+    with open(suppression_file) as file_handle:
+        data = json.load(file_handle)
+        return data['ignore_recursive']
 
-]
 
 class PathScanner:
     def __init__(self):
         self.slipped_paths = set()
 
-    def scan_path(self, path: str) -> typing.Iterable[pathlib.Path]:
-        for root, dirs, files in os.walk(path, followlinks=False):
-            if any(root.startswith(s) for s in self.slipped_paths):
+    def load_suppressions(self, suppression_file: typing.Optional[str]) -> None:
+        """Skip the directories listed in a suppression file, if there is one."""
+        if suppression_file is None or not os.path.exists(suppression_file):
+            return
+        logger.debug("Using suppression file")
+        for skipped_dir in get_skippable_directories(suppression_file):
+            logger.debug("Adding: %s", skipped_dir)
+            self.slipped_paths.add(skipped_dir)
+
+    def scan_path(self, path: str) -> typing.Iterable[str]:
+        for entry in self.scan_entries(path):
+            yield entry.path
+
+    def scan_entries(self, path: str) -> typing.Iterable[os.DirEntry]:
+        # Walks the tree top-down in the same order os.walk would, but uses
+        # the type information cached on each DirEntry instead of stat-ing
+        # every file again to build a pathlib.Path and check for symlinks.
+        skipped_names = self.slipped_paths | {".git"}
+        skipped_prefixes = tuple(self.slipped_paths)
+        pending_directories = [path]
+        while pending_directories:
+            root = pending_directories.pop()
+            if root.startswith(skipped_prefixes):
+                continue
+            try:
+                with os.scandir(root) as entries:
+                    entries = sorted(entries, key=operator.attrgetter("name"))
+            except OSError:
                 continue
-            if ".git" in dirs:
-                dirs.remove(".git")
-            for sub_directory in dirs:
-                if sub_directory in self.slipped_paths or \
-                        os.path.join(path, sub_directory) in self.slipped_paths:
-                    dirs.remove(sub_directory)
-            dirs.sort()
-            files.sort()
-            for f in files:
-                if f in SYSTEM_FILES:
-                    continue
-                file_path = pathlib.Path(os.path.join(root, f))
-                if file_path.is_symlink():
-                    continue
-                yield file_path
\ No newline at end of file
+            sub_directories = []
+            for entry in entries:
+                # Regular files are by far the most common entry, and are
+                # told apart from symlinks and directories with one check.
+                if entry.is_file(follow_symlinks=False):
+                    if entry.name not in SYSTEM_FILES:
+                        yield entry
+                elif entry.is_dir(follow_symlinks=False):
+                    if entry.name in skipped_names or \
+                            os.path.join(path, entry.name) in self.slipped_paths:
+                        continue
+                    sub_directories.append(entry.path)
+            pending_directories.extend(reversed(sub_directories))
@@ -1,22 +1,133 @@
-__all__ = ["add_to_csv_file"]
+__all__ = ["add_to_csv_file", "CsvAppender"]
 
-import hashlib
 import os
 import pathlib
 import sqlite3
+import stat
 import typing
 import csv
 import contextlib
 from time import sleep
 from typing import Optional, Type
 import abc
-import functools
+import collections
+import itertools
+import concurrent.futures
+import threading
+
+from cronenberg import connection, hashing
+
+
+class CsvAppender(contextlib.AbstractContextManager):
+    """Append rows to a csv file, keeping it open between rows."""
+    buffer_size = 1024 * 1024
+
+    def __init__(self, file_name: str, fieldnames: typing.Optional[typing.List[str]] = None):
+        self.file_name = file_name
+        self.fieldnames = fieldnames
+        self._file_handle: typing.Optional[typing.TextIO] = None
+        self._writer: typing.Optional[csv.DictWriter] = None
+
+    def __enter__(self):
+        self._file_handle = open(self.file_name, "a", newline="", buffering=self.buffer_size)
+        return self
+
+    def __exit__(self, exc_type: Optional[Type[BaseException]],
+                 exc_value: Optional[BaseException],
+                 traceback) -> Optional[bool]:
+        if self._file_handle is not None:
+            self._file_handle.close()
+        return None
+
+    def add(self, data: typing.Mapping[str, typing.Any]) -> None:
+        if self._writer is None:
+            # Without explicit field names the columns follow the first row.
+            if self.fieldnames is None:
+                self.fieldnames = list(data)
+            self._writer = csv.DictWriter(self._file_handle, fieldnames=self.fieldnames)
+        self._writer.writerow(data)
 
 
 def add_to_csv_file(file_name: str, data: typing.Mapping[str, typing.Any]) -> None:
-    with open(file_name, "a") as f:
-        writer = csv.writer(f)
-        writer.writerow(data.values())
+    with CsvAppender(file_name) as appender:
+        appender.add(data)
+
+
+# SQLite before 3.32 only allows 999 bound parameters per statement.
+MAX_SQL_PARAMETERS = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+MAX_ROWS_PER_INSERT = 500
+RECORDS_BATCH_SIZE = 10000
+
+
+def insert_many(cursor: sqlite3.Cursor, insert_sql: str, rows: typing.Iterable[typing.Sequence]) -> None:
+    """Insert rows using multi-row VALUES statements.
+
+    insert_sql is the statement for a single row, ending in its VALUES
+    placeholder group, which is repeated for the full chunks. Whatever is
+    left over is inserted row by row.
+    """
+    statement, placeholders = insert_sql.rsplit("VALUES", 1)
+    placeholders = placeholders.strip()
+    rows = iter(rows)
+    first_row = next(rows, None)
+    if first_row is None:
+        return
+    chunk_size = max(1, min(MAX_ROWS_PER_INSERT, MAX_SQL_PARAMETERS // len(first_row)))
+    chunk_sql = f"{statement}VALUES {', '.join([placeholders] * chunk_size)}"
+    rows = itertools.chain([first_row], rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if len(chunk) < chunk_size:
+            cursor.executemany(insert_sql, chunk)
+            return
+        cursor.execute(chunk_sql, list(itertools.chain.from_iterable(chunk)))
+
+
+def probe_files(file_names: typing.Iterable[str]) -> typing.Dict[str, typing.Tuple[str, int]]:
+    """Stat each file once, giving the (name, size) used to find matches."""
+    return {
+        file_name: (os.path.basename(file_name), os.stat(file_name).st_size)
+        for file_name in file_names
+    }
+
+
+def probe_entries(entries: typing.Iterable[os.DirEntry]) -> typing.Dict[str, typing.Tuple[str, int]]:
+    """Same as probe_files, but for files found with os.scandir.
+
+    The stat results are taken from the entries, which on Windows come
+    with the directory listing itself.
+    """
+    return {entry.path: (entry.name, entry.stat().st_size) for entry in entries}
+
+
+def _join_probes(
+        cursor: sqlite3.Cursor,
+        probes: typing.Iterable[typing.Tuple[str, int]],
+        columns: str
+) -> typing.List[typing.Tuple]:
+    """Select the columns of every file matching one of the (name, size) probes.
+
+    All the probes are looked up with one join instead of one query per
+    file. The columns are those of "files f".
+    """
+    cursor.execute(
+        '''
+        CREATE TEMP TABLE IF NOT EXISTS probes
+        (name TEXT, size INTEGER, PRIMARY KEY (name, size)) WITHOUT ROWID
+        '''
+    )
+    try:
+        cursor.executemany('INSERT OR IGNORE INTO temp.probes VALUES (?, ?)', probes)
+        cursor.execute(
+            f'''
+            SELECT {columns}
+            FROM files f
+            JOIN temp.probes p ON f.name = p.name AND f.size = p.size
+            '''
+        )
+        return cursor.fetchall()
+    finally:
+        cursor.execute('DROP TABLE temp.probes')
 
 
 class DataSchema(abc.ABC):
@@ -52,75 +163,122 @@ class DataSchema(abc.ABC):
     def find_matches(self, cur: sqlite3.Cursor, file_name: str) -> typing.List[str]:
         pass
 
+    def find_matches_many(
+            self,
+            cur: sqlite3.Cursor,
+            probes: typing.Mapping[str, typing.Tuple[str, int]],
+            hash_cache: typing.Optional["HashCache"] = None
+    ) -> typing.Dict[str, typing.Any]:
+        """Find the matches of many files, given as made by probe_files.
+
+        Schemas comparing file contents take the hash values from
+        hash_cache, when given, so they are shared between searches.
+        """
+        return {file_name: self.find_matches(cur, file_name) for file_name in probes}
+
 
 class DataSchema1(DataSchema):
 
     def find_matches(self, cursor: sqlite3.Cursor, file_name: str) -> typing.Set[str]:
-        stats = os.stat(file_name)
-        file_path = pathlib.Path(file_name)
-        cursor.execute('SELECT * FROM files WHERE name = ? AND size = ?', (file_path.name, stats.st_size))
-        matches: typing.Set[str] = set()
-        for match_file_name, match_path, match_size in cursor.fetchall():
-            matches.add(os.path.join(match_path, match_file_name))
-        return matches
+        return self.find_matches_many(cursor, probe_files([file_name]))[file_name]
+
+    def find_matches_many(
+            self,
+            cursor: sqlite3.Cursor,
+            probes: typing.Mapping[str, typing.Tuple[str, int]],
+            hash_cache: typing.Optional["HashCache"] = None
+    ) -> typing.Dict[str, typing.Set[str]]:
+        if len(probes) == 1:
+            return {
+                file_name: self._find_name_size_matches(cursor, name, size)
+                for file_name, (name, size) in probes.items()
+            }
+        found: typing.DefaultDict[typing.Tuple[str, int], typing.Set[str]] = collections.defaultdict(set)
+        for match_file_name, match_path, match_size in _join_probes(cursor, probes.values(), "f.name, f.path, f.size"):
+            found[(match_file_name, match_size)].add(os.path.join(match_path, match_file_name))
+        return {file_name: set(found.get(probe, ())) for file_name, probe in probes.items()}
+
+    @staticmethod
+    def _find_name_size_matches(cursor: sqlite3.Cursor, name: str, size: int) -> typing.Set[str]:
+        cursor.execute('SELECT path FROM files WHERE name = ? AND size = ?', (name, size))
+        return {os.path.join(match_path, name) for match_path, in cursor.fetchall()}
 
     def init_tables(self, cursor):
 
         cursor.execute('DROP TABLE IF EXISTS files')
         cursor.execute('''
             CREATE TABLE files
-            (name text, path text, size number)
+            (name text, path text, size INTEGER)
             ''')
+        self.create_indexes(cursor)
+
+    INDEX_NAMES = ("idx_files_name_size", "idx_files_name_path")
+
+    def create_indexes(self, cursor: sqlite3.Cursor):
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_name_size ON files(name, size)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_name_path ON files(name, path)')
+
+    def drop_indexes(self, cursor: sqlite3.Cursor):
+        for index_name in self.INDEX_NAMES:
+            cursor.execute(f'DROP INDEX IF EXISTS {index_name}')
 
     def add_files(self,
                   cursor,
                   records: typing.List[typing.Tuple[str, str, int]],
                   source=None):
-        cursor.executemany('INSERT INTO files VALUES (?, ?, ?)',
-                           records
-                           )
+        insert_many(cursor, 'INSERT INTO files VALUES (?, ?, ?)', records)
 
     def add_file(self, cursor, file_name, data):
         cursor.execute('INSERT INTO files VALUES (?, ?, ?)',
                        (file_name, str(data.path), data.size))
 
-    @functools.lru_cache()
     def record_exists(self, cursor, file_name, data) -> bool:
         cursor.execute(
-            "SELECT * FROM files WHERE name = ? AND path = ? ",
+            "SELECT 1 FROM files WHERE name = ? AND path = ? LIMIT 1",
             (file_name, data.path))
         return cursor.fetchone() is not None
 
+    def record_keys(self, cursor) -> typing.Iterator[typing.Tuple[str, str]]:
+        yield from cursor.execute("SELECT name, path FROM files")
+
     def any_already_exists(self, cursor, file_names: typing.List[pathlib.Path]) -> typing.List[pathlib.Path]:
-        # s = "SELECT * FROM files WHERE name IN ({0}) AND path IN ({0})".format(', '.join('?' for _ in file_names))
-        # n = ([f.name for f in file_names], [f.root for f in file_names])
-        # cursor.execute(s, n
-        #     # "SELECT * FROM files WHERE name IN ({0})".format(', '.join('?' for _ in file_names)),
-        #     # (f.name for f in file_names)
-        # )
-        # cursor.execute(
-        #     "SELECT * FROM files WHERE name in ? AND path in ?",
-        #     ((f.name for f in file_names), (f.root for f in file_names)))
-        # res = cursor.fetchall()
-        res = set()
-        for f in file_names:
-            cursor.execute(
-                "SELECT * FROM files WHERE name = ? AND path = ? ",
-                (f.name, f.root))
-            r = cursor.fetchone()
-            if r is not None:
-                res.add(f)
-        return list(res)
+        if not file_names:
+            return []
+        # Probe every file with a single join instead of one SELECT per file.
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS probe(name TEXT, path TEXT)')
+        try:
+            cursor.executemany(
+                'INSERT INTO temp.probe VALUES (?, ?)',
+                ((f.name, f.root) for f in file_names)
+            )
+            existing = set(
+                cursor.execute(
+                    '''
+                    SELECT p.name, p.path
+                    FROM temp.probe p
+                    JOIN files f ON f.name = p.name AND f.path = p.path
+                    '''
+                )
+            )
+        finally:
+            cursor.execute('DROP TABLE temp.probe')
+        return list({f for f in file_names if (f.name, f.root) in existing})
 
     def records(self, cursor) -> typing.Iterator[
         typing.List[typing.Tuple[str, str, int]]]:
 
-        for r in cursor.execute("SELECT * FROM files ORDER BY path "):
-            yield r
+        yield from self._fetch_in_batches(cursor, "SELECT name, path, size FROM files ORDER BY path ")
+
+    @staticmethod
+    def _fetch_in_batches(cursor: sqlite3.Cursor, sql: str) -> typing.Iterator[typing.Tuple]:
+        # fetchmany builds the rows in C, a batch at a time.
+        cursor.arraysize = RECORDS_BATCH_SIZE
+        cursor.execute(sql)
+        while rows := cursor.fetchmany():
+            yield from rows
 
 
 class DataSchema2(DataSchema1):
-    pass
 
     def init_tables(self, cursor: sqlite3.Cursor):
         cursor.execute('DROP TABLE IF EXISTS metadata')
@@ -128,21 +286,28 @@ class DataSchema2(DataSchema1):
         cursor.execute('INSERT INTO metadata VALUES (2)')
 
         cursor.execute('DROP TABLE IF EXISTS files')
+        # Clustered on the file's location, the lookups by name and size
+        # are answered from the covering index instead.
         cursor.execute('''
                     CREATE TABLE files
-                    (source text, name text, path text, size number, md5 text)
+                    (source text NOT NULL, name text NOT NULL, path text NOT NULL, size INTEGER, md5 text,
+                    PRIMARY KEY (source, path, name)) WITHOUT ROWID
                     ''')
+        self.create_indexes(cursor)
+
+    INDEX_NAMES = ("idx_files_cover", "idx_files_name_path")
 
+    def create_indexes(self, cursor: sqlite3.Cursor):
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_cover ON files(name, size, md5, path, source)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_files_name_path ON files(name, path)')
 
     def add_files(self, cursor: sqlite3.Cursor,
                   records: typing.List[typing.Tuple[str, str, str, int]],
                   source=None):
 
-        cursor.executemany(
-            '''
-            INSERT INTO files (source, name, path, size) 
-            VALUES (?, ?, ?, ?)
-            ''',
+        insert_many(
+            cursor,
+            'INSERT OR IGNORE INTO files (source, name, path, size) VALUES (?, ?, ?, ?)',
             records
         )
     #
@@ -150,7 +315,8 @@ class DataSchema2(DataSchema1):
     def records(self, cursor: sqlite3.Cursor) -> typing.Iterator[
         typing.List[typing.Tuple[str, str, int]]]:
 
-        yield from cursor.execute(
+        yield from self._fetch_in_batches(
+            cursor,
             "SELECT name, path, size FROM files ORDER BY path "
         )
 
@@ -169,20 +335,40 @@ class DataSchema2(DataSchema1):
         #     matches.add(os.path.join(match_path, match_file_name))
         # return matches
 
+    def find_matches_many(
+            self,
+            cursor: sqlite3.Cursor,
+            probes: typing.Mapping[str, typing.Tuple[str, int]],
+            hash_cache: typing.Optional["HashCache"] = None
+    ) -> typing.Dict[str, typing.Set[typing.Tuple[str, str]]]:
+        comparison = FileNameSizeMd5Comparison(cursor, hash_cache=hash_cache)
+        return comparison.find_matches_many(probes)
+
 
 class SQLiteReader(contextlib.AbstractContextManager):
+    max_workers = 8
+
     def __init__(self, filenames: typing.List[str], schema_strategy):
         self.filenames = filenames
         self._con = None
         self.strategy: DataSchema = schema_strategy
+        self._hash_cache: typing.Optional[HashCache] = None
 
     def __enter__(self):
-        self._con = [sqlite3.connect(filename) for filename in self.filenames]
+        # The connections are writable as DataSchema2 stores the hash values
+        # it calculates. Each map is searched on its own thread, see
+        # find_probe_matches.
+        self._con = [connection.connect(filename, check_same_thread=False) for filename in self.filenames]
+        # Files found in more than one map are only hashed once.
+        self._hash_cache = HashCache(max_workers=hashing.MAX_HASH_WORKERS).__enter__()
         return self
 
     def __exit__(self, exc_type: Optional[Type[BaseException]],
                  exc_value: Optional[BaseException],
                  traceback) -> Optional[bool]:
+        if self._hash_cache is not None:
+            self._hash_cache.__exit__(exc_type, exc_value, traceback)
+            self._hash_cache = None
         if self._con is not None:
             for s in self._con:
                 s.commit()
@@ -190,22 +376,54 @@ class SQLiteReader(contextlib.AbstractContextManager):
         return None
 
     def find_matches(self, file_names):
-        matches = []
-        for con in self._con:
-            cur = con.cursor()
-            matches += filter(lambda x: os.path.join(*x) == file_names, self.strategy.find_matches(cur, file_names))
+        return self.find_matches_many([file_names])[file_names]
+
+    def find_matches_many(self, file_names: typing.List[str]) -> typing.Dict[str, typing.List]:
+        # Stat the files once here rather than once for every map.
+        return self.find_probe_matches(probe_files(file_names))
+
+    def find_probe_matches(
+            self,
+            probes: typing.Mapping[str, typing.Tuple[str, int]]
+    ) -> typing.Dict[str, typing.List]:
+        """Find the matches of files given as made by probe_files."""
+        matches: typing.Dict[str, typing.List] = {file_name: [] for file_name in probes}
+        # Every connection is only used by one thread at a time.
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(self.max_workers, len(self._con)) or 1
+        ) as executor:
+            results = executor.map(
+                lambda con: self.strategy.find_matches_many(con.cursor(), probes, hash_cache=self._hash_cache),
+                self._con
+            )
+            for map_matches in results:
+                for file_name, file_matches in map_matches.items():
+                    matches[file_name] += filter(lambda x: os.path.join(*x) == file_name, file_matches)
         # os.path.join(self.base_path, match_path, match_file_name) == str(file_name)
         return matches
 
 class SQLiteWriter(contextlib.AbstractContextManager):
-    def __init__(self, filename: str, schema_strategy):
+    # Used while filling a brand new map, which is simply created again if
+    # the machine goes down part way through. Only applies to the one
+    # connection, so nothing needs to be restored afterwards.
+    BULK_LOAD_PRAGMAS = """
+        PRAGMA synchronous=OFF;
+        PRAGMA cache_size=-131072;
+    """
+
+    def __init__(self, filename: str, schema_strategy, bulk_load: bool = False):
         self.filename = filename
         self._con = None
         self.strategy: DataSchema = schema_strategy
+        self.bulk_load = bulk_load
+        self._records_added = False
+        # (name, path) of every record, loaded on the first lookup.
+        self._existing_records: typing.Optional[typing.Set[typing.Tuple[str, str]]] = None
 
     def __enter__(self):
-        self._con = sqlite3.connect(self.filename)
-
+        self._con = connection.connect(self.filename)
+        if self.bulk_load:
+            self._con.executescript(self.BULK_LOAD_PRAGMAS)
         return self
 
     def __exit__(self, exc_type: Optional[Type[BaseException]],
@@ -213,6 +431,9 @@ class SQLiteWriter(contextlib.AbstractContextManager):
                  traceback) -> Optional[bool]:
         if self._con is not None:
             self._con.commit()
+            if self._records_added:
+                # Refresh the planner statistics so the indexes get used.
+                self._con.execute("ANALYZE")
             self._con.close()
         return None
 
@@ -222,25 +443,46 @@ class SQLiteWriter(contextlib.AbstractContextManager):
         self.strategy.init_tables(cur)
         self._con.commit()
 
+    def commit(self):
+        self._con.commit()
+
+    def create_indexes(self):
+        cur = self._con.cursor()
+        self.strategy.create_indexes(cur)
+        self._con.commit()
+
+    def drop_indexes(self):
+        cur = self._con.cursor()
+        self.strategy.drop_indexes(cur)
+        self._con.commit()
+
     def add_files(self,
                   records: typing.List[typing.Tuple[str, str, int]],
                   source: typing.Optional[str] = None
                   ):
         cur = self._con.cursor()
         # todo check if any files exists in the database already
+        if not records:
+            return
+        changes_before = self._con.total_changes
         self.strategy.add_files(cur, records, source)
+        # Rows already in the map are ignored, not inserted.
+        if self._con.total_changes != changes_before:
+            self._records_added = True
 
     def add_file(self, file_name, data):
         cur = self._con.cursor()
         if not self.already_exists(cur, file_name, data):
             print(file_name)
             self.strategy.add_file(cur, file_name, data)
+            self._existing_records.add((file_name, str(data.path)))
         else:
             print(f"skipping {file_name}")
 
-    @functools.lru_cache()
     def already_exists(self, cur, file_name, data) -> bool:
-        return self.strategy.record_exists(cur, file_name, data)
+        if self._existing_records is None:
+            self._existing_records = set(self.strategy.record_keys(cur))
+        return (file_name, str(data.path)) in self._existing_records
 
     def any_already_exists(self, file_names: typing.List[str]) -> typing.List[str]:
         cur = self._con.cursor()
@@ -249,9 +491,15 @@ class SQLiteWriter(contextlib.AbstractContextManager):
 
     def get_records(self):
         cur = self._con.cursor()
-        for r in self.strategy.records(cur):
-            yield r
-        # yield from self.strategy.records(cur)
+        yield from self.strategy.records(cur)
+
+    def get_record_keys(self) -> typing.Set[typing.Tuple[str, str]]:
+        """Get the (path, name) of every record."""
+        cur = self._con.cursor()
+        # Every file in a directory shares the same path, so keep one copy
+        # of each path string instead of one per record.
+        paths: typing.Dict[str, str] = {}
+        return {(paths.setdefault(path, path), name) for name, path in self.strategy.record_keys(cur)}
 
     def find_matches(self, file_names):
         cur = self._con.cursor()
@@ -268,11 +516,9 @@ class FileNameSizeComparison(AbsFileMatchFinderStrategy):
         self.cursor = cursor
 
     def find_matches(self, file_name: str) -> typing.Set[str]:
-        stats = os.stat(file_name)
-        file_path = pathlib.Path(file_name)
         self.cursor.execute(
             'SELECT name,path, size FROM files WHERE name = ? AND size = ?',
-            (file_path.name, stats.st_size)
+            (os.path.basename(file_name), os.stat(file_name).st_size)
         )
         matches: typing.Set[str] = set()
         for match_file_name, match_path, match_size in self.cursor.fetchall():
@@ -280,73 +526,216 @@ class FileNameSizeComparison(AbsFileMatchFinderStrategy):
         return matches
 
 
+class HashCache(contextlib.AbstractContextManager):
+    """Hash values of files by real path, each file hashed once.
+
+    Files asked for by several threads at once are only hashed once, the
+    later callers wait for the hash already in progress. Inside a with
+    block every hash is calculated on one shared thread pool, which is
+    shut down on leaving it. Otherwise each call uses its own.
+    """
+
+    def __init__(self, max_workers: int = hashing.MAX_HASH_WORKERS):
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._shared = False
+        self._executor: typing.Optional[concurrent.futures.ThreadPoolExecutor] = None
+        # None for files that could not be hashed.
+        self._hash_values: typing.Dict[str, typing.Optional[str]] = {}
+        self._in_progress: typing.Dict[str, concurrent.futures.Future] = {}
+
+    def __enter__(self):
+        self._shared = True
+        return self
+
+    def __exit__(self, exc_type: Optional[Type[BaseException]],
+                 exc_value: Optional[BaseException],
+                 traceback) -> Optional[bool]:
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+            self._shared = False
+        if executor is not None:
+            executor.shutdown()
+        return None
+
+    def get_many(self, real_paths: typing.Iterable[str]) -> typing.Dict[str, str]:
+        """Get the hash values of the files, leaving out those without one."""
+        real_paths = sorted(set(real_paths))
+        with contextlib.ExitStack() as stack:
+            futures = {}
+            with self._lock:
+                executor = self._executor
+                for real_path in real_paths:
+                    if real_path in self._hash_values:
+                        continue
+                    future = self._in_progress.get(real_path)
+                    if future is None:
+                        if executor is None:
+                            executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+                            if self._shared:
+                                self._executor = executor
+                            else:
+                                stack.callback(executor.shutdown)
+                        future = executor.submit(self._hash_file, real_path)
+                        self._in_progress[real_path] = future
+                    futures[real_path] = future
+            for real_path, future in futures.items():
+                self._finish(real_path, future)
+        return {
+            real_path: self._hash_values[real_path]
+            for real_path in real_paths
+            if self._hash_values.get(real_path) is not None
+        }
+
+    def _finish(self, real_path: str, future: concurrent.futures.Future) -> None:
+        # Only the hash value is kept once done, not the future.
+        error = future.exception()
+        with self._lock:
+            if self._in_progress.get(real_path) is future:
+                del self._in_progress[real_path]
+                if error is None:
+                    self._hash_values[real_path] = future.result()
+        if error is not None:
+            raise error
+
+    @staticmethod
+    def _hash_file(file_path: str) -> typing.Optional[str]:
+        print(f"Calculating hash for {file_path}")
+        try:
+            return hashing.hash_file(file_path)
+        except FileNotFoundError:
+            return None
+        except PermissionError as e:
+            print(f"unable to validate {e.filename}")
+            return None
+
+
 class FileNameSizeMd5Comparison(AbsFileMatchFinderStrategy):
-    def __init__(self, cursor):
+    max_hash_workers = hashing.MAX_HASH_WORKERS
+
+    def __init__(self, cursor, hash_cache: typing.Optional[HashCache] = None):
         self.cursor = cursor
         self.base_path = '\\\\Ds1522\\ds1522a'
+        self._hash_cache = hash_cache if hash_cache is not None else HashCache(max_workers=self.max_hash_workers)
+        self._fingerprints: typing.Dict[str, typing.Optional[bytes]] = {}
+        self._pending_hash_updates: typing.List[typing.Tuple[str, str, str]] = []
 
     def find_matches(self, file_name: str) -> typing.Set[typing.Tuple[str, str]]:
-        stats = os.stat(file_name)
-        file_path = pathlib.Path(file_name)
-
-        self.cursor.execute(
-                '''
-                SELECT md5 
-                FROM files 
-                WHERE name = ? AND size = ? AND path = ?
-                ''',
-                (file_path.name, stats.st_size, str(file_path.relative_to(self.base_path).parent))
+        return self.find_matches_many(probe_files([file_name]))[file_name]
+
+    def find_matches_many(
+            self,
+            probes: typing.Mapping[str, typing.Tuple[str, int]]
+    ) -> typing.Dict[str, typing.Set[typing.Tuple[str, str]]]:
+        candidates = self._find_candidates(set(probes.values()))
+        stale_candidates = {
+            file_name: self._stale_candidates(file_name, candidates.get(probe, []))
+            for file_name, probe in probes.items()
+        }
+        # The scanned file itself only needs hashing if the map has no
+        # current hash for it and something is left to compare it with.
+        unhashed_files = [
+            file_name for file_name, probe in probes.items()
+            if self._mapped_hash(file_name, candidates.get(probe, [])) is None and (
+                stale_candidates[file_name] or
+                any(hashing.is_current(candidate[4]) for candidate in candidates.get(probe, []))
+            )
+        ]
+        # Hash every stale candidate and scanned file of the batch in one go.
+        hash_values = self._get_md5_values(
+            list(itertools.chain(unhashed_files, *stale_candidates.values()))
         )
-        file_matches = self.cursor.fetchall()
-        file_md5 = None
-        if file_matches:
-            file_md5 = file_matches[0][0]
+        matches = {
+            file_name: self._match_candidates(
+                file_name,
+                candidates.get(probe, []),
+                {
+                    file_path: hash_values[file_path]
+                    for file_path in itertools.chain([file_name], stale_candidates[file_name])
+                    if file_path in hash_values
+                }
+            )
+            for file_name, probe in probes.items()
+        }
+        self.flush()
+        return matches
+
+    def _find_candidates(
+            self,
+            probes: typing.Set[typing.Tuple[str, int]]
+    ) -> typing.Dict[typing.Tuple[str, int], typing.List[typing.Tuple[str, str, str, int, str]]]:
+        candidates = collections.defaultdict(list)
+        for row in _join_probes(self.cursor, probes, "f.source, f.name, f.path, f.size, f.md5"):
+            candidates[(row[1], row[3])].append(row)
+        return candidates
+
+    def _match_candidates(
+            self,
+            file_name: str,
+            candidates: typing.List[typing.Tuple[str, str, str, int, str]],
+            hash_values: typing.Mapping[str, str]
+    ) -> typing.Set[typing.Tuple[str, str]]:
+        """Pick the candidates with the same hash as the file.
+
+        hash_values holds the new hashes of the file, unless the map has a
+        current one, and of the stale candidates worth comparing, keyed by
+        path. Other stale candidates are skipped.
+        """
+        relative_parent = os.path.relpath(os.path.dirname(file_name), self.base_path)
+        file_md5 = self._mapped_hash(file_name, candidates)
         matches: typing.Set[typing.Tuple[str, str]] = set()
-        for match_source, match_file_name, match_path, match_size, match_md5 in self.cursor.execute(
-                '''
-                SELECT source, name, path, size, md5 
-                FROM files 
-                WHERE name = ? AND size = ?
-                ''',
-                (file_path.name, stats.st_size)
-        ):
+        for match_source, match_file_name, match_path, match_size, match_md5 in candidates:
             # if os.path.join(self.base_path, match_path, match_file_name) == str(file_name):
             #     continue
-            if match_md5 is None:
-                if \
-                        not os.path.exists(os.path.join(match_source, match_path, match_file_name)) or \
-                        not os.path.isfile(os.path.join(match_source, match_path, match_file_name)):
+            if not hashing.is_current(match_md5):
+                match_md5 = hash_values.get(os.path.join(match_source, match_path, match_file_name))
+                if match_md5 is None:
                     continue
-                match_md5 = self.get_md5(os.path.join(match_source, match_path, match_file_name))
 
                 self.update_match_hash(match_path, match_file_name, match_md5)
 
-            try:
-                if file_md5 is None:
-                    file_md5 = self.get_md5(file_name)
-                    if file_md5:
-                        self.update_match_hash(str(file_path), str(file_name), file_md5)
-            except PermissionError as e:
-                print(f"unable to validate {e.filename}")
-                return set()
+            if file_md5 is None:
+                file_md5 = hash_values.get(file_name)
+                if file_md5 is not None:
+                    self.update_match_hash(relative_parent, os.path.basename(file_name), file_md5)
             if match_md5 == file_md5:
                 matches.add((match_source, os.path.join(match_path, match_file_name)))
 
         return matches
 
+    def _mapped_hash(
+            self,
+            file_name: str,
+            candidates: typing.List[typing.Tuple[str, str, str, int, str]]
+    ) -> typing.Optional[str]:
+        relative_parent = os.path.relpath(os.path.dirname(file_name), self.base_path)
+        file_md5 = next(
+            (match_md5 for _, _, match_path, _, match_md5 in candidates if match_path == relative_parent),
+            None
+        )
+        # Values from an older hash algorithm are recalculated.
+        return file_md5 if hashing.is_current(file_md5) else None
+
     def update_match_hash(self, path, file_name, md5_hash):
+        self._pending_hash_updates.append((md5_hash, path, file_name))
+
+    def flush(self):
+        """Write and commit the hash values cached by update_match_hash."""
+        if not self._pending_hash_updates:
+            return
         update_attempts = 2
         for attempt_number in range(update_attempts):
             try:
-                self.cursor.execute(
+                self.cursor.executemany(
                     '''
                     UPDATE files
                     SET md5 = ?
                     WHERE path=? AND name=?
                     ''',
-                    (md5_hash, path, file_name)
+                    self._pending_hash_updates
                 )
-                # self.cursor.commit()
+                self.cursor.connection.commit()
                 break
             except sqlite3.OperationalError as e:
                 if attempt_number + 1 < update_attempts:
@@ -354,23 +743,63 @@ class FileNameSizeMd5Comparison(AbsFileMatchFinderStrategy):
                     print("Sleeping for 1 second and trying again")
                     sleep(1)
                 else:
-                    print(f"Unable cache hash value for {file_name}")
+                    print(f"Unable cache hash values for {len(self._pending_hash_updates)} files")
+        self._pending_hash_updates.clear()
+
+    def _stale_candidates(
+            self,
+            file_name: str,
+            candidates: typing.List[typing.Tuple[str, str, str, int, str]]
+    ) -> typing.List[str]:
+        """Paths of the candidates without a current hash that could match.
+
+        Candidates whose fingerprint differs from the file are left
+        unhashed, they can not be a match.
+        """
+        stale = []
+        for match_source, match_file_name, match_path, match_size, match_md5 in candidates:
+            if hashing.is_current(match_md5):
+                continue
+            candidate_path = os.path.join(match_source, match_path, match_file_name)
+            try:
+                candidate_stat = os.stat(candidate_path)
+            except OSError:
+                continue
+            # A different size means the file changed since it was mapped.
+            if not stat.S_ISREG(candidate_stat.st_mode) or candidate_stat.st_size != match_size:
+                continue
+            stale.append(candidate_path)
+        if not stale:
+            return stale
+        file_fingerprint = self._fingerprint(file_name)
+        if file_fingerprint is None:
+            return stale
+        return [
+            candidate_path for candidate_path in stale
+            if self._fingerprint(candidate_path) == file_fingerprint
+        ]
+
+    def _fingerprint(self, file_path: str) -> typing.Optional[bytes]:
+        if file_path not in self._fingerprints:
+            try:
+                self._fingerprints[file_path] = hashing.fingerprint_file(file_path)
+            except OSError:
+                self._fingerprints[file_path] = None
+        return self._fingerprints[file_path]
+
+    def _get_md5_values(self, file_paths: typing.List[str]) -> typing.Dict[str, str]:
+        """Hash the files in parallel, skipping any hashed before."""
+        real_paths = {file_path: os.path.realpath(file_path) for file_path in file_paths}
+        hash_values = self._hash_cache.get_many(real_paths.values())
+        return {
+            file_path: hash_values[real_path]
+            for file_path, real_path in real_paths.items()
+            if real_path in hash_values
+        }
 
     @staticmethod
     def get_md5(file_path: str) -> str:
-        if not os.path.exists(os.path.exists(file_path)):
-            raise FileNotFoundError(file_path)
         if not os.path.isfile(file_path):
             raise FileNotFoundError(file_path)
-        print(f"Calculating md5 for {file_path}")
-        with open(file_path, "rb") as f:
-            file_hash = hashlib.md5()
-            start = os.fstat(f.fileno()).st_size
-            # print(start)
-            while chunk := f.read(8192 * 8):
-                percent_done = f.tell() / start
-                file_hash.update(chunk)
-                # print(f"\r{(percent_done * 100):.2f} %")
-                print(f"\r{(percent_done * 100):.2f} %", flush=True if percent_done == 1.0 else False, end='\n' if percent_done == 1.0 else '')
-
-        return file_hash.hexdigest()
+        print(f"Calculating hash for {file_path}")
+        return hashing.hash_file(file_path)
@@ -1,9 +1,9 @@
 import abc
 import contextlib
+import csv
 import importlib.resources
 import logging
 import os
-import pathlib
 import shutil
 import sqlite3
 import time
@@ -11,7 +11,7 @@ import typing
 from types import TracebackType
 from typing import Optional, Type
 import cronenberg
-from cronenberg import database
+from cronenberg import database, connection
 import html
 
 class DuplicateReportGenerator(contextlib.AbstractContextManager):
@@ -24,6 +24,14 @@ class DuplicateReportGenerator(contextlib.AbstractContextManager):
 
 
 class DuplicateReportSqlite(DuplicateReportGenerator):
+    INSERT_MATCH_SQL = "INSERT INTO match_files VALUES (?, ?, ?)"
+    INSERT_MAPPED_SQL = "INSERT INTO mapped_files VALUES (?, ?, ?)"
+
+    # Number of add_duplicates calls written per transaction.
+    commit_interval = 1000
+
+    # Number of rows fetched from SQLite at a time by duplicates().
+    fetch_size = 1000
 
     class Record(typing.NamedTuple):
         filename: str
@@ -33,172 +41,193 @@ class DuplicateReportSqlite(DuplicateReportGenerator):
     def __init__(self, filename: str, ):
         super().__init__(filename)
         self._con = None
+        self._cur: typing.Optional[sqlite3.Cursor] = None
+        self._uncommitted_duplicates = 0
 
         # self.strategy
 
     def remove_local_files(
             self,
             files: typing.Iterable[str]
-    ) -> typing.Set[str]:
-
-        buffer_size = 100
+    ) -> typing.Set[typing.Tuple[str, str]]:
 
         logger = logging.getLogger('cronenberg')
-        logger.debug(f"Pruning files {files}")
-        cur = self._con.cursor()
+        debug_enabled = logger.isEnabledFor(logging.DEBUG)
+        if debug_enabled:
+            logger.debug(f"Pruning files {files}")
 
-        pruned: typing.Set[str] = set()
-
-        buffer: typing.Set[typing.Tuple[str, str]] = set()
-        for f in sorted(files, key=lambda x: x.lower()):
-            path, file_name = os.path.split(f)
-            buffer.add((path, file_name))
-            if len(buffer) > buffer_size:
-                removal_files = [
-                    os.path.join(fn[0], fn[1]) for fn in sorted(buffer, key=lambda x: x[1])
-                ]
-                logger.debug(f"Removing from database: [{', '.join(removal_files)}]")
-                cur.executemany(
+        pruned: typing.Set[typing.Tuple[str, str]] = {os.path.split(f) for f in files}
+        if debug_enabled:
+            removal_files = sorted((os.path.join(*fn) for fn in pruned), key=lambda x: x.lower())
+            logger.debug(f"Removing from database: [{', '.join(removal_files)}]")
+
+        cur = self._con.cursor()
+        # All of the files are removed by a single delete, committed together.
+        with self._con:
+            cur.execute('CREATE TEMP TABLE IF NOT EXISTS prune(path TEXT, name TEXT)')
+            try:
+                cur.executemany('INSERT INTO temp.prune VALUES (?, ?)', pruned)
+                cur.execute(
+                    """
+                    DELETE FROM match_files
+                    WHERE (path, name) IN (SELECT path, name FROM temp.prune)
                     """
-                    DELETE FROM match_files WHERE path = ? AND name = ?
-                    """,
-                    buffer
                 )
-                pruned.update(buffer)
-                buffer.clear()
-        removal_files = [
-                os.path.join(fn[0], fn[1]) for fn in sorted(buffer, key=lambda x: x[1])
-            ]
-        logger.debug(f"Removing from database: [{', '.join(removal_files)}]")
-        cur.executemany(
-            """
-            DELETE FROM match_files WHERE path = ? AND name = ?
-            """,
-            buffer
-        )
-        pruned.update(buffer)
+            finally:
+                cur.execute('DROP TABLE temp.prune')
         return pruned
 
     def duplicates(self) -> typing.Iterable[Record]:
         logger = logging.getLogger('cronenberg')
         cur = self._con.cursor()
         logger.debug("Retrieving records of duplicates")
-        cur.execute(
-            '''
-            SELECT COUNT(*)
-            FROM mapped_files join match_files mf on mapped_files.match_id = mf.ROWID
-            '''
-        )
-        s = cur.fetchone()
-        number_of_matches = s[0]
+        # Progress is reported by elapsed time, counting the rows up front
+        # would mean running the whole join twice.
+        log_progress = logger.isEnabledFor(logging.DEBUG)
         start_time = time.time()
+        last_report_time = start_time
+        number_of_records = 0
 
-        for i, result in enumerate(
-                cur.execute(
-                    '''
-                    SELECT 
-                        mapped_files.name, 
-                        mf.path as local_path, 
-                        mapped_files.path as network_files, 
-                        size
-                    FROM mapped_files join match_files mf on mapped_files.match_id = mf.ROWID
-                    ORDER BY local_path ASC , mapped_files.name ASC  ;
-                    '''
-            )
-        ):
-
-            yield DuplicateReportSqlite.Record(
-                filename=result[0],
-                local_file=os.path.join(result[1], result[0]),
-                mapped_file=os.path.join(result[2], result[0]),
+        # Duplicates are matched on the exact file name, so ordering by the
+        # local name lets idx_match_files_path_name drive the join and
+        # SQLite no longer sorts the whole result in a temp b-tree.
+        cur.arraysize = self.fetch_size
+        cur.execute(
+            f'''
+            SELECT 
+                mapped_files.name, 
+                {database.join_path_sql("mf.path", "mapped_files.name")} as local_file, 
+                {database.join_path_sql("mapped_files.path", "mapped_files.name")} as mapped_file
+            FROM match_files mf join mapped_files on mapped_files.match_id = mf.ROWID
+            ORDER BY mf.path ASC , mf.name ASC  ;
+            ''',
+            database.PATH_SEPARATOR_PARAMETERS
+        )
+        for number_of_records, result in enumerate(self._iter_fetched_rows(cur), start=1):
+
+            yield DuplicateReportSqlite.Record._make(result)
+            # Only look at the clock every 1024 rows.
+            if log_progress and number_of_records & 1023 == 0:
+                now = time.time()
+                if now - last_report_time > 1:
+                    logger.debug(
+                        f"Retrieving records of duplicates: "
+                        f"{number_of_records} in {now - start_time:.1f}s"
+                    )
+                    last_report_time = now
+        if log_progress:
+            logger.debug(
+                f"Retrieved {number_of_records} records of duplicates "
+                f"in {time.time() - start_time:.1f}s"
             )
-            if (i + 1) % int(number_of_matches/10) == 0 or \
-                    number_of_matches == i + 1 or \
-                    time.time() - start_time > 1:
-
-                completed = ((i + 1) / number_of_matches) * 100
-
-                logger.debug(
-                    f"Retrieving records of duplicates: "
-                    f"({i+1} / {number_of_matches}): {completed:.3f}%"
-                )
-
-                start_time = time.time()
         cur.close()
 
+    @staticmethod
+    def _iter_fetched_rows(cursor: sqlite3.Cursor) -> typing.Iterator[typing.Tuple]:
+        while rows := cursor.fetchmany():
+            yield from rows
 
     def init_tables(self):
-        cur = self._con.cursor()
-        cur.execute('DROP TABLE IF EXISTS match_files')
-        cur.execute('DROP TABLE IF EXISTS mapped_files')
-        cur.execute('''
+        # All of the schema changes are made in a single transaction.
+        self._con.executescript('''
+            BEGIN;
+            DROP TABLE IF EXISTS match_files;
+            DROP TABLE IF EXISTS mapped_files;
             CREATE TABLE match_files
-            (path text, name TEXT, size INTEGER )
-            ''')
+            (path text, name TEXT, size INTEGER );
 
-        cur.execute('''
             CREATE TABLE mapped_files
-            (path TEXT, name TEXT , match_id INTEGER, FOREIGN KEY(match_id) REFERENCES mapped_files(ROWID))
+            (path TEXT, name TEXT , match_id INTEGER, FOREIGN KEY(match_id) REFERENCES mapped_files(ROWID));
+            CREATE INDEX IF NOT EXISTS idx_match_files_path_name ON match_files(path, name);
+            CREATE INDEX IF NOT EXISTS idx_mapped_match_id ON mapped_files(match_id);
+            COMMIT;
             ''')
         # self.strategy.init_tables(cur)
-        self._con.commit()
 
-    def add_duplicates(self, source, duplicates):
-        cur = self._con.cursor()
+    def add_duplicates(self, source, duplicates, source_size: typing.Optional[int] = None):
+        cur = self._cur
         # path, file_name
+        source_path, source_name = os.path.split(source)
+        if source_size is None:
+            source_size = os.stat(source).st_size
         cur.execute(
-            "INSERT INTO match_files VALUES (?, ?, ?)",
-            (str(source.parent), source.name, source.stat().st_size)
+            self.INSERT_MATCH_SQL,
+            (source_path, source_name, source_size)
         )
         mapped_id = cur.lastrowid
-        for duplicate in duplicates:
-            file_ = pathlib.Path(duplicate)
-
-            cur.execute(
-                "INSERT INTO mapped_files VALUES (?, ?, ?)",
-                (str(file_.parent), file_.name, mapped_id)
-            )
-        self._con.commit()
+        cur.executemany(
+            self.INSERT_MAPPED_SQL,
+            (os.path.split(duplicate) + (mapped_id,) for duplicate in duplicates)
+        )
+        self._uncommitted_duplicates += 1
+        if self._uncommitted_duplicates >= self.commit_interval:
+            self._con.commit()
+            self._uncommitted_duplicates = 0
 
     def __enter__(self):
         # if os.path.exists(self.filename):
         #     os.remove(self.filename)
-        self._con = sqlite3.connect(self.filename)
-
+        self._con = connection.connect(self.filename)
+        # Shared by every add_duplicates call.
+        self._cur = self._con.cursor()
         return self
 
     def __exit__(self, __exc_type: Optional[Type[BaseException]],
                  __exc_value: Optional[BaseException],
                  __traceback: Optional[TracebackType]) -> Optional[bool]:
         if self._con is not None:
+            if self._cur is not None:
+                self._cur.close()
+                self._cur = None
             self._con.commit()
             self._con.close()
         return super().__exit__(__exc_type, __exc_value, __traceback)
 
 
 class DuplicateReportCSV(DuplicateReportGenerator):
+    buffer_size = 1024 * 1024
+
+    # Number of rows handed to csv.writer.writerows at a time.
+    rows_per_write = 1024
+
+    def __init__(self, filename: str):
+        super().__init__(filename)
+        self._file_handle: typing.Optional[typing.TextIO] = None
+        self._writer = None
+        self._pending_rows: typing.List[typing.List[str]] = []
 
     def add_duplicates(self, source, duplicates):
-        if self.filename is not None:
-            with open(self.filename, "a") as out_file:
-                out_file.write(f"{source}, {','.join(duplicates)} \n")
+        if self._writer is not None:
+            self._pending_rows.append([str(source), *duplicates])
+            if len(self._pending_rows) >= self.rows_per_write:
+                self._write_pending_rows()
+
+    def _write_pending_rows(self):
+        self._writer.writerows(self._pending_rows)
+        self._pending_rows.clear()
 
     def __enter__(self):
         if self.filename is not None:
-            if os.path.exists(self.filename):
-                os.remove(self.filename)
+            self._file_handle = open(self.filename, "w", newline="", buffering=self.buffer_size)
+            self._writer = csv.writer(self._file_handle)
         return self
 
     def __exit__(self, __exc_type: Optional[Type[BaseException]],
                  __exc_value: Optional[BaseException],
                  __traceback: Optional[TracebackType]) -> Optional[bool]:
+        if self._file_handle is not None:
+            self._write_pending_rows()
+            self._file_handle.close()
         return super().__exit__(__exc_type, __exc_value, __traceback)
 
 class HTMLFormatter:
+    page_size = 1000
+
     def __init__(self, item_column_headings: typing.List[str], instance_column_headings: typing.List[str]):
         self._item_column_names: typing.List[str] = item_column_headings
         self._instance_columns: typing.List[str] = instance_column_headings
-
+        # The same header row is written at the top of every page.
+        self._table_header = self.generate_table_header()
 
     def generate_table_header(self):
         return ''.join(
@@ -208,29 +237,37 @@ class HTMLFormatter:
             ]
         )
 
-    def _generate_table(self, items):
-        table_rows = []
-        for row_i, (item, instances) in enumerate(items):
+    def _iter_table_rows(self, items):
+        # The empty cells are the same on every row, so build them once.
+        item_padding = f'<td class="item emptycell" colspan="{len(self._instance_columns)}"></td>'
+        instance_padding = f'<td class="instance emptycell" colspan="{len(self._item_column_names)}"></td>'
+        instance_start = f'<tr class="instance">{instance_padding}<td class="instance">'
+        escape = html.escape
+        for item, instances in items:
             item_row = ''.join(
-                [f'<td class="item">{html.escape(str(value))}</td>' for value in item] +
-                ['<td class="item emptycell" colspan="{len(self._instance_columns)}"></td>']
+                [f'<td class="item">{escape(str(value))}</td>' for value in item] +
+                [item_padding]
             )
-            table_rows.append(f'<tr class="item">{item_row}</tr>')
-            instance_rows = []
+            yield f'<tr class="item">{item_row}</tr>'
             for instance in instances:
-                instance_rows.append(
-                    f'<tr class="instance"><td class="instance emptycell" colspan="{len(self._item_column_names)}"></td><td class="instance">{html.escape(instance)}</td></tr>')
-            table_rows += instance_rows
-        tables_rows_html = '\n'.join([value for value in table_rows])
-        return f"""<table cellspacing="0" cellpadding="0">
+                yield f'{instance_start}{escape(instance)}</td></tr>'
+
+    def write_table(self, writer: typing.TextIO, items) -> None:
+        writer.write(f"""<table cellspacing="0" cellpadding="0">
                     <tr>
-                        {self.generate_table_header()}
+                        {self._table_header}
                     </tr>
-                {tables_rows_html}
+                """)
+        for i, row in enumerate(self._iter_table_rows(items)):
+            if i:
+                writer.write("\n")
+            writer.write(row)
+        writer.write("""
                 </table>
-        """
-    def _generate_page(self, content):
-        return f"""<!DOCTYPE html>
+        """)
+
+    def _page_start(self):
+        return """<!DOCTYPE html>
         <html lang="en">
         <head>
             <meta charset="UTF-8">
@@ -239,33 +276,50 @@ class HTMLFormatter:
         </head>
         <body>
             <h1>Duplication Report</h1>
-            {content}
+            """
+
+    def _page_end(self):
+        return """
         </body>
         </html>
 
         """
 
-    def _iter_get_page_content(self, items):
-        page_size = 1000
+    def _generate_page(self, content):
+        return f"{self._page_start()}{content}{self._page_end()}"
+
+    def number_of_pages(self, number_of_items: int) -> int:
+        # A page is closed after item 0, then after every page_size more,
+        # and whatever is left over always becomes the last page.
+        return max(number_of_items - 1, 0) // self.page_size + 1
+
+    def iter_page_items(self, items):
         page_content = []
         for i, item in enumerate(items):
             page_content.append(item)
-            if i % page_size == 0 and i != 0:
-                yield self._generate_table(page_content)
-                page_content.clear()
-        yield self._generate_table(page_content)
-
-    def iter_items_to_pages(self, items):
-        all_page_content = list(self._iter_get_page_content(items))
-        header = self.generate_header(len(all_page_content))
-        for content in all_page_content:
-            yield self._generate_page(
-                f"""<div>
+            if i % self.page_size == 0 and i != 0:
+                yield page_content
+                page_content = []
+        yield page_content
+
+    def write_page(self, writer: typing.TextIO, header: str, items) -> None:
+        writer.write(self._page_start())
+        writer.write(f"""<div>
                 <div>{header}</div>
-                <div>{content}</div>
+                <div>""")
+        self.write_table(writer, items)
+        writer.write("""</div>
                 </div>
-                """
-            )
+                """)
+        writer.write(self._page_end())
+
+    def generate_index_page(self, header: str) -> str:
+        return self._generate_page(
+            f"""<div>
+            {header}
+</div>"""
+        )
+
     def generate_header(self, number_of_pages):
         header_rows = []
         row_contents = []
@@ -281,20 +335,10 @@ class HTMLFormatter:
             [f'<div class="row">{row}</div>' for row in header_rows]
         ).strip()
         return f'"<div class="header">{header}</div>"'
-    def generate(self, items):
-        content_pages = list(self.iter_items_to_pages(items))
-        header =self.generate_header(len(content_pages))
-        front_page_data = self._generate_page(
-            f"""<div>
-            {header}
-</div>"""
-        )
 
-        for i, page in enumerate(content_pages):
-            yield f"page{i + 1}.html", page
-        yield "index.html", front_page_data
 
 class HTMLOutputReport:
+    write_buffer_size = 1024 * 1024
 
     def __init__(self, output_path) -> None:
         super().__init__()
@@ -314,10 +358,14 @@ class HTMLOutputReport:
             writer.write(importlib.resources.files(cronenberg).joinpath('styles.css').read_text())
 
         formatter = HTMLFormatter(self._item_column_names, self._instance_columns)
-        pages = formatter.generate(self._items)
-        for page_name, page in pages:
-            with open(os.path.join(self.output_path, page_name), "w", encoding="utf-8") as writer:
-                writer.write(page)
+        header = formatter.generate_header(formatter.number_of_pages(len(self._items)))
+        # Pages are written row by row instead of being built in memory.
+        for i, page_items in enumerate(formatter.iter_page_items(self._items)):
+            page_file = os.path.join(self.output_path, f"page{i + 1}.html")
+            with open(page_file, "w", encoding="utf-8", buffering=self.write_buffer_size) as writer:
+                formatter.write_page(writer, header, page_items)
+        with open(os.path.join(self.output_path, "index.html"), "w", encoding="utf-8") as writer:
+            writer.write(formatter.generate_index_page(header))
 
     def add_record(self, item, instances):
         if len(item) != len(self._item_column_names):
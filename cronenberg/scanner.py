@@ -1,12 +1,15 @@
 
 import abc
+import contextlib
 import os
 import pathlib
 import sys
 import typing
 import argparse
+import concurrent.futures
+import itertools
 import json
-from cronenberg import filescanner, recorder, reports, dups
+from cronenberg import filescanner, recorder, reports, dups, background
 from cronenberg.path_scanner import PathScanner
 from cronenberg.database import DEFAULT_FILE_SYSTEM_MAP_DATA_SCHEME, DupReportDataSchema
 import logging
@@ -223,10 +226,9 @@ class DupsPath(Command):
         with reports.DuplicateReportSqlite(
                 self.dups_file) as report:
             logger.debug("Locating dups entries to prune")
-            for r in report.duplicates():
-                if not os.path.exists(r.local_file):
-                    logger.debug(f"Unable to locate: {r.local_file}")
-                    files_no_longer_existing.add(r.local_file)
+            for local_file in self._find_missing_files(r.local_file for r in report.duplicates()):
+                logger.debug(f"Unable to locate: {local_file}")
+                files_no_longer_existing.add(local_file)
 
             if files_no_longer_existing:
                 pruned_files = report.remove_local_files(
@@ -242,14 +244,35 @@ class DupsPath(Command):
                     "No entries from dups database needed to be pruned"
                 )
 
+    @staticmethod
+    def _find_missing_files(files: typing.Iterable[str]) -> typing.List[str]:
+        # Rather than a stat per file, each directory holding more than one
+        # of the files is listed once. A name missing from the listing is
+        # still confirmed with os.path.exists, as the listing is case
+        # sensitive even where the file system is not.
+        files_by_directory: typing.Dict[str, typing.Set[str]] = {}
+        for file_name in files:
+            parent, name = os.path.split(file_name)
+            files_by_directory.setdefault(parent, set()).add(name)
+        missing_files = []
+        for parent, names in files_by_directory.items():
+            if len(names) > 1:
+                try:
+                    names = names.difference(os.listdir(parent or os.curdir))
+                except OSError:
+                    pass
+            missing_files.extend(
+                file_name for file_name in (os.path.join(parent, name) for name in sorted(names))
+                if not os.path.exists(file_name)
+            )
+        return missing_files
+
     @staticmethod
     def get_records(map_file):
         with recorder.SQLiteWriter(
                 filename=map_file,
                 schema_strategy=dups.DEFAULT_FILE_SYSTEM_MAP_DATA_SCHEME) as reader:
-            existing_files = set()
-            for i, (file_name, file_path, _) in enumerate(reader.get_records()):
-                existing_files.add(os.path.join(file_path, file_name))
+            existing_files = reader.get_record_keys()
             print(f"loaded {len(existing_files)} records")
             return existing_files
 
@@ -286,10 +309,8 @@ class GenerateReport(Command):
         data_reader = DupReportDataSchema()
         report_generator.set_item_columns("File name", "Hash value", "File size")
         report_generator.set_instance_columns('Instance Locations')
-        for (file_name, hash_value, file_size), locations in data_reader.get_dups_from_database_file(self.source):
-            instances = [os.path.join(*location, file_name) for location in locations]
-            if len(instances) < 2:
-                continue
+        for (file_name, hash_value, file_size), instances in \
+                data_reader.get_dup_instances_from_database_file(self.source):
             report_generator.add_record(
                 item=(file_name, hash_value, f"{file_size} bytes"),
                 instances=instances
@@ -298,59 +319,132 @@ class GenerateReport(Command):
 
 
 class MapPath(Command):
+    # Number of scanned files passed to the writer at a time.
+    batch_size = 10000
+
+    # The scan is written in one transaction per this many files, so a long
+    # scan neither holds a single huge transaction nor syncs every batch.
+    commit_interval = 50000
+
+    # The files are stat-ed by a pool of threads, this many at a time, so
+    # the round trips to a network share overlap instead of adding up.
+    max_stat_workers = 8
+    stat_chunk_size = 1000
+
+    # Chunks walked ahead on a separate thread while earlier ones are
+    # stat-ed and written.
+    prefetched_chunks = 4
+
+    # Progress is logged once per this many files instead of for each one.
+    # Must be a power of two.
+    progress_interval = 1024
+
     def __init__(self, args):
 
         self.output_file = args.outputfile
         self.root = args.root
         self._suppression_file = args.suppression_file
         self._append = args.append
+        self._skipped_files = 0
         # self._suppression_file = SUPPRESSION_FILE
 
     def execute(self):
         output_files = self.output_file
-        if self._append is False and not os.path.exists(output_files):
-            with recorder.SQLiteWriter(
-                    filename=output_files,
-                    schema_strategy=DEFAULT_FILE_SYSTEM_MAP_DATA_SCHEME) as writer:
-                writer = typing.cast(recorder.SQLiteWriter, writer)
-                print("initing the tables")
-                writer.init_tables()
-
+        new_map = self._append is False and not os.path.exists(output_files)
         with recorder.SQLiteWriter(
                 filename=output_files,
-                schema_strategy=DEFAULT_FILE_SYSTEM_MAP_DATA_SCHEME) as writer:
-            existing_files = set()
-            for i, (file_name, file_path, _) in enumerate(writer.get_records()):
-                existing_files.add(os.path.join(file_path, file_name))
-            print(f"loaded {len(existing_files)} records")
+                schema_strategy=DEFAULT_FILE_SYSTEM_MAP_DATA_SCHEME,
+                bulk_load=new_map) as writer:
             writer = typing.cast(recorder.SQLiteWriter, writer)
+            if new_map:
+                print("initing the tables")
+                writer.init_tables()
+                # A new map is filled first and indexed once at the end,
+                # which is cheaper than keeping the indexes up to date.
+                writer.drop_indexes()
+            existing_files = writer.get_record_keys()
+            print(f"loaded {len(existing_files)} records")
 
             buffer = []
+            uncommitted_files = 0
+            added_files = 0
+            self._skipped_files = 0
             try:
                 scanner = PathScanner()
-                if self._suppression_file is not None and \
-                        os.path.exists(self._suppression_file):
-                    print("Using suppression file")
-                    for skipped_dir in get_skippable_directories(
-                            self._suppression_file):
-                        scanner.slipped_paths.add(skipped_dir)
-                for f in scanner.scan_path(self.root):
-                    if str(f.relative_to(self.root)) in existing_files or \
-                            not os.path.exists(f):
-                        print(f"Skipping {f.relative_to(self.root)}")
-                        continue
-                    data = filescanner.scan_file(self.root, f)
-                    if data.size == 0:
-                        continue
-
-                    print(f.relative_to(self.root))
-
-                    buffer.append((self.root, f.name, data.path, data.size))
-                    if len(buffer) > 100:
-                        writer.add_files(buffer, source=self.root)
-                        buffer.clear()
+                scanner.load_suppressions(self._suppression_file)
+                new_entries = self._iter_new_entries(scanner.scan_entries(self.root), existing_files)
+                chunks = background.iter_in_background(
+                    iter(lambda: list(itertools.islice(new_entries, self.stat_chunk_size)), []),
+                    max_pending=self.prefetched_chunks
+                )
+                # Closed explicitly so an error while writing does not leave
+                # the walker thread blocked on a full queue.
+                with contextlib.closing(chunks), \
+                        contextlib.closing(self._iter_stat_results(chunks)) as stat_results:
+                    for entry, stat_result in stat_results:
+                        if stat_result is None:
+                            logger.debug("Skipping %s, no longer exists", entry.path)
+                            continue
+                        data = filescanner.scan_file(self.root, entry.path, stat_result)
+                        if data.size == 0:
+                            continue
+
+                        added_files += 1
+                        if added_files & (self.progress_interval - 1) == 0:
+                            logger.info("%d files added, currently in %s", added_files, data.path)
+
+                        buffer.append((self.root, data.filename, data.path, data.size))
+                        if len(buffer) >= self.batch_size:
+                            writer.add_files(buffer, source=self.root)
+                            uncommitted_files += len(buffer)
+                            buffer.clear()
+                            if uncommitted_files >= self.commit_interval:
+                                writer.commit()
+                                uncommitted_files = 0
             finally:
                 writer.add_files(buffer, source=self.root)
+                # Also adds the indexes to maps created before they existed,
+                # so the lookup commands never have to change a map.
+                writer.create_indexes()
+                logger.info(
+                    "Added %d files, skipped %d already in the map",
+                    added_files, self._skipped_files
+                )
+
+    def _iter_new_entries(
+            self,
+            entries: typing.Iterable[os.DirEntry],
+            existing_files: typing.Set[typing.Tuple[str, str]]
+    ) -> typing.Iterator[os.DirEntry]:
+        # Records are keyed on (path, name) exactly as scan_file stores
+        # them. The scanner yields a directory's files together, so the
+        # relative directory is only worked out when it changes.
+        parent = None
+        relative_parent = None
+        for entry in entries:
+            entry_parent = os.path.dirname(entry.path)
+            if entry_parent != parent:
+                parent = entry_parent
+                relative_parent = os.path.relpath(parent, self.root)
+            if (relative_parent, entry.name) in existing_files:
+                self._skipped_files += 1
+                continue
+            yield entry
+
+    def _iter_stat_results(
+            self,
+            chunks: typing.Iterable[typing.List[os.DirEntry]]
+    ) -> typing.Iterator[typing.Tuple[os.DirEntry, typing.Optional[os.stat_result]]]:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_stat_workers) as executor:
+            for chunk in chunks:
+                yield from zip(chunk, executor.map(self._try_stat, chunk))
+
+    @staticmethod
+    def _try_stat(entry: os.DirEntry) -> typing.Optional[os.stat_result]:
+        try:
+            return entry.stat()
+        except FileNotFoundError:
+            return None
 
 
 def main(argv: typing.Optional[typing.List[str]] = None):